@@ -2,7 +2,6 @@ import os
 import sys
 import sqlite3
 import ctypes
-import shutil
 import time
 import threading
 import logging
@@ -11,6 +10,14 @@ from tkinter import ttk, filedialog, messagebox
 from PIL import Image, ImageTk, ImageDraw, ImageFont
 from datetime import datetime
 import json
+import collections
+import functools
+import heapq
+import itertools
+import pathlib
+import queue
+from concurrent.futures import Future
+from contextlib import contextmanager
 
 USE_TTKBOOTSTRAP = False
 try:
@@ -23,11 +30,60 @@ except Exception:
 APP_TITLE = "Cafenet Pro — Inventory Manager"
 CONFIG_FILE = "config.txt"
 DB_FILENAME = "inventory.db"
+# bump whenever _create_schema changes, so existing databases rerun it once
+SCHEMA_VERSION = 3
 LOG_FILENAME = "actions.log"
+UNDO_FILENAME = "undo_stack.json"
+UNDO_STACK_LIMIT = 200
+ICON_CACHE_LIMIT = 256
 ICON_FOLDER_DEFAULT = os.path.join(os.path.expanduser("~"), "Desktop", "Cyber")
 BACKUP_FOLDER_NAME = "backups"
 DEFAULT_BACKUP_INTERVAL = 60 * 10
 LOW_STOCK_THRESHOLD_DEFAULT = 5
+SEARCH_DEBOUNCE_MS = 150
+REFRESH_DEBOUNCE_MS = 50
+DB_POLL_MS = 20
+HISTORY_PAGE_SIZE = 100
+# up to this many matched products, filtered history seeks each one's sales; past it, one scan is cheaper
+HISTORY_SEEK_MAX_PRODUCTS = 8
+# fraction of the history list scrolled past before the next page is fetched
+HISTORY_PREFETCH_AT = 0.9
+HISTORY_LOADING_IID = "loading"
+# ORDER BY clause for each stock filter; unlisted filters keep newest first
+FILTER_ORDER_BY = {
+    "کمترین موجودی": "qty ASC, id DESC",
+    "پرفروش‌ترین": "sold_qty DESC",
+    "پربازده‌ترین": "(sold_qty * (sell_price - buy_price)) DESC",
+}
+
+# hot-path statements, kept as constants so every call hits the connection's statement cache
+# ids are bound as one JSON array, so any selection size reuses the same prepared statement
+SQL_SELECT_PRODUCTS = ("SELECT id, name, qty, sold_qty, buy_price, sell_price FROM products"
+                       " WHERE id IN (SELECT value FROM json_each(?))")
+SQL_INSERT_PRODUCT = "INSERT INTO products (name, qty, buy_price, sell_price) VALUES (?, ?, ?, ?)"
+SQL_SELL_PRODUCT = "UPDATE products SET qty=qty-?, sold_qty=sold_qty+? WHERE id=?"
+SQL_UNSELL_PRODUCT = "UPDATE products SET qty=qty+?, sold_qty=MAX(sold_qty-?, 0) WHERE id=?"
+SQL_RESTORE_PRODUCT = "INSERT OR REPLACE INTO products (id, name, qty, buy_price, sell_price, sold_qty) VALUES (?, ?, ?, ?, ?, ?)"
+SQL_BUMP_PRODUCT_SEQ = "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name='products'"
+SQL_DELETE_PRODUCT = "DELETE FROM products WHERE id=?"
+SQL_INSERT_SALE = "INSERT INTO sales_log (product_id, qty, price_buy, price_sell, profit, timestamp) VALUES (?, ?, ?, ?, ?, ?)"
+SQL_DELETE_SALE = "DELETE FROM sales_log WHERE id=?"
+SQL_INSERT_LOG = "INSERT INTO logs (action, details) VALUES (?, ?)"
+# running totals kept by the stats triggers, so the report never scans products or sales_log
+SQL_REPORT_TOTALS = "SELECT in_stock, total_qty, total_value, total_sold, total_profit FROM stats WHERE id=1"
+# keyset page of sales history: newest first, continuing below the last id shown
+# product names are resolved separately through SQL_PRODUCT_NAMES, once per product per window
+SQL_SALES_PAGE = ("SELECT id, product_id, qty, price_buy, price_sell, profit, timestamp"
+                  " FROM sales_log WHERE id < ? ORDER BY id DESC LIMIT ?")
+# same page for one product; a (product_id=? AND rowid<?) seek on idx_sales_log_product_id, already in id order
+SQL_PRODUCT_SALES_PAGE = ("SELECT id, product_id, qty, price_buy, price_sell, profit, timestamp FROM sales_log"
+                          " WHERE product_id = ? AND id < ? ORDER BY id DESC LIMIT ?")
+# same page for many products: walks sales_log newest first and stops after a page of matches;
+# the unary + keeps the planner off idx_sales_log_product_id, which would need a sort
+SQL_PRODUCTS_SALES_PAGE = ("SELECT id, product_id, qty, price_buy, price_sell, profit, timestamp FROM sales_log"
+                           " WHERE +product_id IN (SELECT value FROM json_each(?)) AND id < ? ORDER BY id DESC LIMIT ?")
+SQL_MATCHING_PRODUCTS = "SELECT rowid FROM products_fts WHERE products_fts MATCH ?"
+SQL_PRODUCT_NAMES = "SELECT id, name FROM products WHERE id IN (SELECT value FROM json_each(?))"
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s [%(levelname)s] %(message)s",
@@ -40,14 +96,50 @@ def is_admin():
     except Exception:
         return False
 
-def get_connection(db_path):
-    conn = sqlite3.connect(db_path, timeout=10)
+def get_connection(db_path, read_only=False):
+    # autocommit mode; multi-statement writes issue BEGIN/COMMIT explicitly
+    if read_only:
+        conn = sqlite3.connect(pathlib.Path(db_path).resolve().as_uri() + "?mode=ro", uri=True,
+                               check_same_thread=False, isolation_level=None, cached_statements=256)
+        conn.execute("PRAGMA query_only=1;")
+    else:
+        conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None,
+                               cached_statements=256)
+    # journal_mode=WAL is persistent in the file and set once by init_db; the rest are per-connection.
+    # busy_timeout bounds how long a statement waits on the backup thread's lock
+    conn.execute("PRAGMA busy_timeout=5000;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
     conn.execute("PRAGMA foreign_keys = ON;")
+    # lets INSERT OR REPLACE fire the delete triggers for the row it replaces, keeping stats and FTS exact
+    conn.execute("PRAGMA recursive_triggers=ON;")
+    conn.execute("PRAGMA cache_size=-20000;")
+    conn.execute("PRAGMA wal_autocheckpoint=1000;")
+    conn.execute("PRAGMA mmap_size=268435456;")
     return conn
 
-def init_db(db_path):
-    conn = get_connection(db_path)
+def init_db(conn):
+    # runs on the app's own connection, so schema setup doesn't pay for a second open
     c = conn.cursor()
+    # a file already at SCHEMA_VERSION has everything below; startup then costs one header read
+    if c.execute("PRAGMA user_version;").fetchone()[0] == SCHEMA_VERSION:
+        return
+    # page_size only takes effect on a fresh file, so it must precede WAL and the first table;
+    # neither can change inside a transaction
+    c.execute("PRAGMA page_size=4096;")
+    c.execute("PRAGMA journal_mode=WAL;")
+    # all DDL and the version stamp commit together, so a failed upgrade is retried on the next start
+    c.execute("BEGIN")
+    try:
+        _create_schema(c)
+        c.execute(f"PRAGMA user_version={SCHEMA_VERSION};")
+        c.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            c.execute("ROLLBACK")
+        raise
+
+def _create_schema(c):
     c.execute("""
         CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -79,25 +171,104 @@ def init_db(db_path):
             FOREIGN KEY(product_id) REFERENCES products(id) ON DELETE SET NULL
         );
     """)
-    # persistent undo stack table
+    # undo history lives in memory now (checkpointed to UNDO_FILENAME on close)
+    c.execute("DROP TABLE IF EXISTS undo_stack;")
+    # history pages by id, so a timestamp index would only cost every sale insert
+    c.execute("DROP INDEX IF EXISTS idx_sales_log_ts;")
+    # products deletes null out sales_log.product_id (ON DELETE SET NULL), and filtered history
+    # seeks (product_id=? AND rowid<?) with the implicit rowid
+    c.execute("DROP INDEX IF EXISTS idx_sales_log_product;")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sales_log_product_id ON sales_log(product_id);")
+    # covering index for seeding stats; its leading qty column also serves the stock filters
+    c.execute("DROP INDEX IF EXISTS idx_products_qty;")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_agg ON products(qty, buy_price, sold_qty);")
+    # full-text index over product names so search is an index lookup instead of a LIKE '%q%' scan;
+    # it replaces idx_products_name, which no query uses any more
+    c.execute("DROP INDEX IF EXISTS idx_products_name;")
+    fts_exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='products_fts'").fetchone()
     c.execute("""
-        CREATE TABLE IF NOT EXISTS undo_stack (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            action TEXT NOT NULL,
-            payload TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts
+        USING fts5(name, content='products', content_rowid='id', tokenize='unicode61');
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_ai AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts(rowid, name) VALUES (new.id, new.name);
+        END;
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_ad AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        END;
+    """)
+    # only name changes touch the index; qty/sold_qty updates on every sale skip it
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_au AFTER UPDATE OF name ON products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+            INSERT INTO products_fts(rowid, name) VALUES (new.id, new.name);
+        END;
+    """)
+    if not fts_exists:
+        c.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild');")
+    # one-row table of report totals, updated by triggers with each write's delta
+    stats_exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='stats'").fetchone()
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            in_stock INTEGER NOT NULL DEFAULT 0,
+            total_qty INTEGER NOT NULL DEFAULT 0,
+            total_value INTEGER NOT NULL DEFAULT 0,
+            total_sold INTEGER NOT NULL DEFAULT 0,
+            total_profit INTEGER NOT NULL DEFAULT 0
         );
     """)
-    conn.commit()
-    conn.close()
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_stats_ai AFTER INSERT ON products BEGIN
+            UPDATE stats SET in_stock = in_stock + (new.qty > 0), total_qty = total_qty + new.qty,
+                total_value = total_value + new.qty * new.buy_price, total_sold = total_sold + new.sold_qty
+            WHERE id = 1;
+        END;
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_stats_ad AFTER DELETE ON products BEGIN
+            UPDATE stats SET in_stock = in_stock - (old.qty > 0), total_qty = total_qty - old.qty,
+                total_value = total_value - old.qty * old.buy_price, total_sold = total_sold - old.sold_qty
+            WHERE id = 1;
+        END;
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_stats_au AFTER UPDATE OF qty, buy_price, sold_qty ON products BEGIN
+            UPDATE stats SET in_stock = in_stock + (new.qty > 0) - (old.qty > 0), total_qty = total_qty + new.qty - old.qty,
+                total_value = total_value + new.qty * new.buy_price - old.qty * old.buy_price,
+                total_sold = total_sold + new.sold_qty - old.sold_qty
+            WHERE id = 1;
+        END;
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS sales_log_stats_ai AFTER INSERT ON sales_log BEGIN
+            UPDATE stats SET total_profit = total_profit + new.profit WHERE id = 1;
+        END;
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS sales_log_stats_ad AFTER DELETE ON sales_log BEGIN
+            UPDATE stats SET total_profit = total_profit - old.profit WHERE id = 1;
+        END;
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS sales_log_stats_au AFTER UPDATE OF profit ON sales_log BEGIN
+            UPDATE stats SET total_profit = total_profit + new.profit - old.profit WHERE id = 1;
+        END;
+    """)
+    if not stats_exists:
+        c.execute("""
+            INSERT OR REPLACE INTO stats (id, in_stock, total_qty, total_value, total_sold, total_profit)
+            SELECT 1, COALESCE(SUM(qty > 0),0), COALESCE(SUM(qty),0), COALESCE(SUM(qty*buy_price),0),
+                   COALESCE(SUM(sold_qty),0), (SELECT COALESCE(SUM(profit),0) FROM sales_log)
+            FROM products;
+        """)
 
-def log_action(db_path, action, details):
+def log_action(conn, action, details):
     try:
-        conn = get_connection(db_path)
-        c = conn.cursor()
-        c.execute("INSERT INTO logs (action, details) VALUES (?, ?)", (action, details))
-        conn.commit()
-        conn.close()
+        conn.execute(SQL_INSERT_LOG, (action, details))
     except Exception as e:
         logging.exception("DB log failed: %s", e)
     logging.info("%s — %s", action, details)
@@ -108,27 +279,41 @@ _backup_stop = threading.Event()
 def make_backup_periodic(db_path, folder, interval_seconds=DEFAULT_BACKUP_INTERVAL):
     os.makedirs(folder, exist_ok=True)
     def worker():
-        while not _backup_stop.is_set():
-            try:
-                ts = time.strftime("%Y%m%d_%H%M%S")
-                dst = os.path.join(folder, f"inventory_backup_{ts}.db")
-                shutil.copy2(db_path, dst)
-                keep_last_n_backups(folder, 20)
-                logging.info("Backup created: %s", dst)
-            except Exception as e:
-                logging.exception("Backup failed: %s", e)
-            _backup_stop.wait(interval_seconds)
+        # the worker has its own connection; the app's connection is never used from this thread
+        src = get_connection(db_path)
+        try:
+            while not _backup_stop.is_set():
+                try:
+                    ts = time.strftime("%Y%m%d_%H%M%S")
+                    dst_path = os.path.join(folder, f"inventory_backup_{ts}.db")
+                    # fold the WAL into the main file first so it stays small
+                    src.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                    # online backup gives a consistent snapshot and only locks 200 pages per step
+                    dst = sqlite3.connect(dst_path)
+                    try:
+                        src.backup(dst, pages=200, sleep=0.005)
+                    finally:
+                        dst.close()
+                    keep_last_n_backups(folder, 20)
+                    logging.info("Backup created: %s", dst_path)
+                except Exception as e:
+                    logging.exception("Backup failed: %s", e)
+                _backup_stop.wait(interval_seconds)
+        finally:
+            src.close()
     t = threading.Thread(target=worker, daemon=True)
     t.start()
     return t
 
 def keep_last_n_backups(folder, n=20):
     try:
-        files = sorted([os.path.join(folder, f) for f in os.listdir(folder) if f.startswith("inventory_backup_")])
-        if len(files) > n:
-            for f in files[:-n]:
+        # names embed %Y%m%d_%H%M%S, so lexical order is age order and no stat() is needed
+        with os.scandir(folder) as it:
+            entries = [(e.name, e.path) for e in it if e.name.startswith("inventory_backup_")]
+        if len(entries) > n:
+            for name, path in heapq.nsmallest(len(entries) - n, entries):
                 try:
-                    os.remove(f)
+                    os.remove(path)
                 except:
                     pass
     except Exception:
@@ -137,41 +322,79 @@ def keep_last_n_backups(folder, n=20):
 def stop_backups():
     _backup_stop.set()
 
-_image_cache = {}
-def generate_fallback_icon(symbol, bg="#2C2C2C", fg="#FFFFFF", size=(48,48)):
-    key = f"fallback_{symbol}_{size}"
-    if key in _image_cache:
-        return _image_cache[key]
+# Tk PhotoImage handles, least recently used first; callers showing an icon keep their own reference
+_image_cache = collections.OrderedDict()
+
+def _cached_image(key):
+    tkimg = _image_cache.get(key)
+    if tkimg is not None:
+        _image_cache.move_to_end(key)
+    return tkimg
+
+def _cache_image(key, tkimg):
+    _image_cache[key] = tkimg
+    _image_cache.move_to_end(key)
+    while len(_image_cache) > ICON_CACHE_LIMIT:
+        _image_cache.popitem(last=False)
+
+_font_cache = {}
+def _font(size_px):
+    font = _font_cache.get(size_px)
+    if font is None:
+        try:
+            font = ImageFont.truetype("arial.ttf", size_px)
+        except OSError:
+            font = ImageFont.load_default()
+        _font_cache[size_px] = font
+    return font
+
+@functools.lru_cache(maxsize=128)
+def _render_fallback(symbol, bg, fg, size):
     img = Image.new("RGBA", size, bg)
     d = ImageDraw.Draw(img)
+    font = _font(int(size[1]*0.5))
+    # textbbox replaces textsize (removed in Pillow 10); offset by the bbox origin to center the glyphs
+    left, top, right, bottom = d.textbbox((0, 0), symbol, font=font)
+    w, h = right - left, bottom - top
+    d.text(((size[0]-w)/2 - left, (size[1]-h)/2 - top), symbol, font=font, fill=fg)
+    return img
+
+@functools.lru_cache(maxsize=128)
+def _load_pil(path, size):
+    """decode and resize an icon once per (path, size); the result is shared, don't mutate it"""
     try:
-        font = ImageFont.truetype("arial.ttf", int(size[1]*0.5))
-    except:
-        font = ImageFont.load_default()
-    w, h = d.textsize(symbol, font=font)
-    d.text(((size[0]-w)/2, (size[1]-h)/2), symbol, font=font, fill=fg)
-    tkimg = ImageTk.PhotoImage(img)
-    _image_cache[key] = tkimg
+        resample = Image.Resampling.LANCZOS
+    except AttributeError:
+        resample = Image.LANCZOS
+    with Image.open(path) as src:
+        rgba = src.convert("RGBA")
+    img = rgba.resize(size, resample)
+    rgba.close()
+    return img
+
+def generate_fallback_icon(symbol, bg="#2C2C2C", fg="#FFFFFF", size=(48,48)):
+    size = tuple(size)
+    key = f"fallback_{symbol}_{size}"
+    tkimg = _cached_image(key)
+    if tkimg is None:
+        tkimg = ImageTk.PhotoImage(_render_fallback(symbol, bg, fg, size))
+        _cache_image(key, tkimg)
     return tkimg
 
 def load_icon(path, size=(48,48), fallback_symbol="?"):
+    size = tuple(size)
     key = f"{path}_{size}"
-    if key in _image_cache:
-        return _image_cache[key]
+    tkimg = _cached_image(key)
+    if tkimg is not None:
+        return tkimg
     try:
         if path and os.path.exists(path):
-            img = Image.open(path).convert("RGBA")
-            try:
-                resample = Image.Resampling.LANCZOS
-            except AttributeError:
-                resample = Image.LANCZOS
-            img = img.resize(size, resample)
-            tkimg = ImageTk.PhotoImage(img)
+            tkimg = ImageTk.PhotoImage(_load_pil(path, size))
         else:
             tkimg = generate_fallback_icon(fallback_symbol, size=size)
     except Exception:
         tkimg = generate_fallback_icon(fallback_symbol, size=size)
-    _image_cache[key] = tkimg
+    _cache_image(key, tkimg)
     return tkimg
 
 def get_database_folder():
@@ -194,14 +417,17 @@ def get_database_folder():
         f.write(folder)
     return folder
 
-def format_price_display(value):
-    try:
-        return f"{int(value):,} تومان"
-    except:
-        return "0 تومان"
+def parse_price(text):
+    # whole tomans only: "1,234" is accepted, "12.5" or "1e3" raise ValueError
+    return int(text.strip().replace(",", ""))
+
+def fts_phrase(text):
+    # the text is quoted as a single phrase so user input can't be parsed as FTS syntax;
+    # the trailing * makes the last word a prefix match
+    return '"' + text.replace('"', '""') + '"*'
 
-def clean_price_text(txt):
-    return txt.replace(",", "").replace(" تومان", "").strip()
+# price columns are INTEGER NOT NULL, so display formatting is one bound C-level str.format call
+_fmt_price = "{:,} تومان".format
 
 class CafenetApp(ttk.Frame):
     def __init__(self, root, db_path, icon_folder=None):
@@ -212,12 +438,29 @@ class CafenetApp(ttk.Frame):
         self.backup_interval = DEFAULT_BACKUP_INTERVAL
         self.low_stock_threshold = LOW_STOCK_THRESHOLD_DEFAULT
         self._prev_hover = None
-        self._highlight_rows = {}
+        self._prev_selection = set()
+        self._search_after = None
+        self._pending_refresh = None
+        # sales history Toplevel, kept (hidden) between opens, and the function that reloads it
+        self._sales_win = None
+        self._sales_reload = None
+        # iid -> (values, tag) currently shown in the tree, used to diff refreshes
+        self._displayed = {}
+        # iid -> raw row (unformatted ints), so column sorts never parse display strings
+        self._sort_keys = {}
+        # last report totals; cleared by every write so searches and filter changes skip the round trip
+        self._report_cache = None
+        # bumped by every write; report reads on the read worker started before a write are discarded
+        self._write_gen = 0
         self._setup_style()
         self._create_vars()
         self._build_ui()
-        init_db(self.db_path)
-        self._load_undo_stack()  # load persistent undo entries into memory (for quick display if needed)
+        # single long-lived connection, owned by the DB worker thread
+        self.conn = get_connection(self.db_path)
+        self._start_db_worker()
+        self._db_call(init_db)  # schema must exist before the first query or backup
+        self._start_read_worker()
+        self._load_undo_stack()  # restore undo entries checkpointed by the previous session
         self.refresh_list()
         backups_folder = os.path.join(os.path.dirname(self.db_path), BACKUP_FOLDER_NAME)
         global _backup_thread
@@ -239,6 +482,8 @@ class CafenetApp(ttk.Frame):
     def _create_vars(self):
         self.var_name = tk.StringVar()
         self.var_qty = tk.StringVar()
+        # prices are typed as plain integers (thousands commas allowed) and parsed with parse_price;
+        # the formatted view is a label next to each entry (empty until typed)
         self.var_buy = tk.StringVar()
         self.var_sell = tk.StringVar()
         self.var_search = tk.StringVar()
@@ -247,8 +492,8 @@ class CafenetApp(ttk.Frame):
         # sell quick quantity
         self.var_sell_qty = tk.IntVar(value=1)
 
-        # in-memory representation of undo stack (mirrors DB table ordering)
-        self._undo_stack = []
+        # bounded in-memory undo stack; oldest entries fall off past UNDO_STACK_LIMIT
+        self._undo_stack = collections.deque(maxlen=UNDO_STACK_LIMIT)
 
     def _build_ui(self):
         self.root.title(APP_TITLE)
@@ -276,12 +521,16 @@ class CafenetApp(ttk.Frame):
         ttk.Label(left, text="قیمت خرید:").pack(anchor="w")
         self.ent_buy = tk.Entry(left, textvariable=self.var_buy, width=22, bg="#FFFFFF", fg="#000000", insertbackground="#000000", justify="right")
         self.ent_buy.pack(pady=4)
-        self.ent_buy.bind("<KeyRelease>", lambda e: self._format_price(self.ent_buy))
+        self.lbl_buy = ttk.Label(left, text="")
+        self.lbl_buy.pack(anchor="e")
+        self.ent_buy.bind("<FocusOut>", lambda e: self._show_price(self.var_buy, self.lbl_buy))
 
         ttk.Label(left, text="قیمت فروش:").pack(anchor="w")
         self.ent_sell = tk.Entry(left, textvariable=self.var_sell, width=22, bg="#FFFFFF", fg="#000000", insertbackground="#000000", justify="right")
         self.ent_sell.pack(pady=4)
-        self.ent_sell.bind("<KeyRelease>", lambda e: self._format_price(self.ent_sell))
+        self.lbl_sell = ttk.Label(left, text="")
+        self.lbl_sell.pack(anchor="e")
+        self.ent_sell.bind("<FocusOut>", lambda e: self._show_price(self.var_sell, self.lbl_sell))
 
         btns = ttk.Frame(left)
         btns.pack(pady=10, fill="x")
@@ -300,7 +549,7 @@ class CafenetApp(ttk.Frame):
         ttk.Label(quick_frame, text="تعداد:").pack(side="left", padx=(6,2))
         self.spin_sell_qty = tk.Spinbox(quick_frame, from_=1, to=9999, width=6, textvariable=self.var_sell_qty, justify="right")
         self.spin_sell_qty.pack(side="left", padx=(0,6))
-        ttk.Button(quick_frame, text="فروش سریع", command=lambda: self.sell_item(self.var_sell_qty.get() if isinstance(self.var_sell_qty.get(), int) else int(self.var_sell_qty.get()))).pack(side="left", padx=6)
+        ttk.Button(quick_frame, text="فروش سریع", command=lambda: self.sell_item(self.var_sell_qty)).pack(side="left", padx=6)
 
         filter_frame = ttk.Frame(left)
         filter_frame.pack(pady=6, fill="x")
@@ -313,7 +562,7 @@ class CafenetApp(ttk.Frame):
         ttk.Label(search_frame, text="جستجو:").pack(side="left")
         ent_search = tk.Entry(search_frame, textvariable=self.var_search, bg="#FFFFFF", fg="#000000", insertbackground="#000000")
         ent_search.pack(side="left", padx=8, fill="x", expand=True)
-        ent_search.bind("<KeyRelease>", lambda e: self.refresh_list())
+        ent_search.bind("<KeyRelease>", lambda e: self._on_search_key())
 
         # Button to open sales history
         ttk.Button(search_frame, text="تاریخچه فروش", command=self.open_sales_history).pack(side="right", padx=6)
@@ -345,227 +594,332 @@ class CafenetApp(ttk.Frame):
         self.status_label = ttk.Label(footer, text="آماده", font=("Segoe UI", 11))
         self.status_label.pack(side="left")
 
-    def _format_price(self, entry):
-        txt = entry.get()
-        cleaned = clean_price_text(txt)
-        if cleaned.isdigit():
-            entry.delete(0, tk.END)
-            entry.insert(0, f"{int(cleaned):,} تومان")
-
-    def db_execute(self, query, params=()):
-        conn = get_connection(self.db_path)
-        c = conn.cursor()
-        c.execute(query, params)
-        conn.commit()
-        conn.close()
+    def _on_search_key(self):
+        # coalesce a burst of keystrokes into one refresh
+        if self._search_after:
+            self.root.after_cancel(self._search_after)
+        self._search_after = self.root.after(SEARCH_DEBOUNCE_MS, self._run_search)
 
-    def db_query(self, query, params=()):
-        conn = get_connection(self.db_path)
-        c = conn.cursor()
-        c.execute(query, params)
-        rows = c.fetchall()
-        conn.close()
-        return rows
+    def _run_search(self):
+        self._search_after = None
+        self.refresh_list()
 
-    # --- persistent undo helpers ---
-    def _push_undo(self, action, payload):
-        """store undo record in DB and in-memory list"""
-        try:
-            conn = get_connection(self.db_path)
-            c = conn.cursor()
-            payload_text = json.dumps(payload, ensure_ascii=False)
-            c.execute("INSERT INTO undo_stack (action, payload, timestamp) VALUES (?, ?, ?)",
-                      (action, payload_text, datetime.now().isoformat()))
-            undo_id = c.lastrowid
-            conn.commit()
-            conn.close()
-            # keep in-memory mirror
-            self._undo_stack.append({"id": undo_id, "action": action, "payload": payload})
-            logging.info("Pushed undo: %s %s", action, payload)
-        except Exception as e:
-            logging.exception("Failed to push undo: %s", e)
+    def schedule_refresh(self):
+        # writes finishing back to back (e.g. repeated undo) share one refresh of the tree and report
+        if self._pending_refresh:
+            return
+        self._pending_refresh = self.root.after(REFRESH_DEBOUNCE_MS, self._do_refresh)
+
+    def _do_refresh(self):
+        self._pending_refresh = None
+        self.refresh_list()
 
-    def _pop_undo_db(self):
-        """pop last undo from DB and in-memory; returns dict or None"""
+    def _show_price(self, var, label):
+        # runs once per field on focus-out; the entry text itself is never rewritten
         try:
-            conn = get_connection(self.db_path)
-            c = conn.cursor()
-            c.execute("SELECT id, action, payload FROM undo_stack ORDER BY id DESC LIMIT 1")
-            row = c.fetchone()
-            if not row:
-                conn.close()
-                return None
-            undo_id, action, payload_text = row
-            # delete it
-            c.execute("DELETE FROM undo_stack WHERE id=?", (undo_id,))
-            conn.commit()
-            conn.close()
+            label.config(text=_fmt_price(parse_price(var.get())))
+        except ValueError:
+            label.config(text="")
+
+    # --- DB worker ---
+    # All writes run on one worker thread that owns self.conn, so disk I/O never blocks Tk.
+    # Display reads (list, report, history) run on a second worker with a read-only connection;
+    # under WAL they see the last committed state and never wait behind a write in progress.
+    # Neither worker calls into Tk: finished jobs with callbacks are handed to the UI thread
+    # through _ui_queue, which _drain_ui_queue polls every DB_POLL_MS while any such job is outstanding.
+    def _start_db_worker(self):
+        self._db_queue = queue.Queue()
+        self._ui_queue = queue.Queue()
+        # callback jobs not yet handled on the Tk thread, and the pending poll (None when idle)
+        self._pending_callbacks = 0
+        self._ui_poll = None
+        self._db_thread = threading.Thread(target=self._db_worker, args=(self._db_queue, self.conn), daemon=True)
+        self._db_thread.start()
+
+    def _start_read_worker(self):
+        # opened after init_db: a read-only connection can't create the file or the schema
+        self.read_conn = get_connection(self.db_path, read_only=True)
+        self._read_queue = queue.Queue()
+        self._read_thread = threading.Thread(target=self._db_worker, args=(self._read_queue, self.read_conn), daemon=True)
+        self._read_thread.start()
+
+    def _db_worker(self, jobs, conn):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            fn, future = job
             try:
-                payload = json.loads(payload_text)
-            except:
-                payload = {}
-            # pop in-memory mirror if matches
-            if self._undo_stack and self._undo_stack[-1].get("id") == undo_id:
-                self._undo_stack.pop()
+                future.set_result(fn(conn))
+            except Exception as e:
+                future.set_exception(e)
+        conn.close()
+
+    def _db_submit(self, fn, callback=None, errback=None, read=False):
+        """queue fn(conn) on the writer (or the reader if read); callback(result) / errback(exc) later run on the Tk thread"""
+        future = Future()
+        if callback or errback:
+            # jobs with callbacks are only submitted from the Tk thread, so the poll can be armed here
+            self._pending_callbacks += 1
+            if self._ui_poll is None:
+                self._ui_poll = self.root.after(DB_POLL_MS, self._drain_ui_queue)
+            future.add_done_callback(lambda f: self._ui_queue.put((f, callback, errback)))
+        (self._read_queue if read else self._db_queue).put((fn, future))
+        return future
+
+    def _db_call(self, fn, read=False):
+        """run fn(conn) on the worker and wait for its result"""
+        if read and threading.current_thread() is self._read_thread:
+            return fn(self.read_conn)
+        if not read and threading.current_thread() is self._db_thread:
+            return fn(self.conn)
+        return self._db_submit(fn, read=read).result()
+
+    def _drain_ui_queue(self):
+        try:
+            while True:
+                try:
+                    future, callback, errback = self._ui_queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._pending_callbacks -= 1
+                try:
+                    exc = future.exception()
+                    if exc is None:
+                        if callback:
+                            callback(future.result())
+                    elif errback:
+                        errback(exc)
+                    else:
+                        logging.error("DB job failed: %s", exc, exc_info=exc)
+                except Exception as e:
+                    logging.exception("DB callback failed: %s", e)
+        finally:
+            # stop polling once nothing is outstanding; the next _db_submit with callbacks re-arms it
+            if self._pending_callbacks:
+                self._ui_poll = self.root.after(DB_POLL_MS, self._drain_ui_queue)
             else:
-                # try to remove by id if present
-                for i in range(len(self._undo_stack)-1, -1, -1):
-                    if self._undo_stack[i].get("id") == undo_id:
-                        self._undo_stack.pop(i)
-                        break
-            return {"id": undo_id, "action": action, "payload": payload}
-        except Exception as e:
-            logging.exception("Failed pop undo from DB: %s", e)
+                self._ui_poll = None
+
+    def db_query(self, query, params=(), callback=None, errback=None, read=False):
+        """read=True runs on the read-only connection; leave it off for reads that a write is about to rely on"""
+        def job(conn):
+            return conn.execute(query, params).fetchall()
+        if callback or errback:
+            self._db_submit(job, callback, errback, read=read)
             return None
+        return self._db_call(job, read=read)
+
+    @contextmanager
+    def _tx(self):
+        """yield a cursor inside a single BEGIN...COMMIT (rolled back on error); worker thread only"""
+        c = self.conn.cursor()
+        c.execute("BEGIN")
+        try:
+            yield c
+            c.execute("COMMIT")
+        except Exception:
+            # a failed COMMIT can leave the transaction open; without this every later BEGIN fails.
+            # some errors already roll back on their own, hence the check
+            if self.conn.in_transaction:
+                c.execute("ROLLBACK")
+            raise
+
+    def db_transaction(self, work, callback=None, errback=None):
+        """run work(cursor) as one transaction on the worker; waits for the result unless callbacks are given"""
+        def job(conn):
+            with self._tx() as c:
+                return work(c)
+        if callback or errback:
+            self._db_submit(job, callback, errback)
+            return None
+        return self._db_call(job)
+
+    def _log(self, action, details, cursor):
+        # always called inside the write's own transaction
+        log_action(cursor, action, details)
+
+    def close_db(self):
+        # pending jobs finish first; each worker closes its connection on its way out
+        self._read_queue.put(None)
+        self._db_queue.put(None)
+        self._read_thread.join(timeout=5)
+        self._db_thread.join(timeout=5)
+    # --- end DB worker ---
+
+    # --- undo helpers ---
+    def _undo_path(self):
+        return os.path.join(os.path.dirname(self.db_path), UNDO_FILENAME)
+
+    def _push_undo(self, action, payload):
+        """push undo record onto the in-memory stack"""
+        self._undo_stack.append({"action": action, "payload": payload})
+        logging.info("Pushed undo: %s %s", action, payload)
+
+    def _pop_undo(self):
+        """pop last undo record; returns dict or None"""
+        return self._undo_stack.pop() if self._undo_stack else None
 
     def _load_undo_stack(self):
-        """Load existing undo stack from DB into memory (ordered by id asc)"""
+        """Load the undo stack checkpointed by the previous session (oldest first)"""
         try:
-            rows = self.db_query("SELECT id, action, payload FROM undo_stack ORDER BY id ASC")
-            self._undo_stack = []
-            for r in rows:
-                uid, act, payload_text = r
-                try:
-                    payload = json.loads(payload_text)
-                except:
-                    payload = {}
-                self._undo_stack.append({"id": uid, "action": act, "payload": payload})
-            logging.info("Loaded %d undo entries from DB", len(self._undo_stack))
+            with open(self._undo_path(), "r", encoding="utf-8") as f:
+                entries = json.load(f)
+            self._undo_stack = collections.deque(entries, maxlen=UNDO_STACK_LIMIT)
+            logging.info("Loaded %d undo entries", len(self._undo_stack))
+            # the checkpoint is consumed: if this session crashes, the next one starts with an empty stack
+            # instead of entries that predate whatever this session wrote
+            os.remove(self._undo_path())
+        except FileNotFoundError:
+            pass
         except Exception as e:
             logging.exception("Failed to load undo stack: %s", e)
-            self._undo_stack = []
+            self._undo_stack = collections.deque(maxlen=UNDO_STACK_LIMIT)
+
+    def save_undo_stack(self):
+        """Checkpoint the undo stack once per session so it survives a restart"""
+        path = self._undo_path()
+        tmp = path + ".tmp"
+        try:
+            # write aside and swap in, so a crash mid-write never leaves a truncated checkpoint
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(list(self._undo_stack), f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except Exception as e:
+            logging.exception("Failed to save undo stack: %s", e)
+
+    # --- end undo helpers ---
+
+    def _tags_for(self, iid, base):
+        # hover replaces the row colour; selection is an extra tag on top of the base one
+        if iid == self._prev_hover:
+            return ("hover",)
+        if iid in self._prev_selection:
+            return (base, "selected")
+        return (base,)
 
-    # --- end persistent undo helpers ---
+    def _restore_tags(self, iid):
+        shown = self._displayed.get(iid)
+        if shown is not None and self.tree.exists(iid):
+            self.tree.item(iid, tags=self._tags_for(iid, shown[1]))
 
     def _on_hover(self, event):
-        row_id = self.tree.identify_row(event.y)
-        if self._prev_hover != row_id:
-            if self._prev_hover is not None and self.tree.exists(self._prev_hover):
-                idx = self.tree.index(self._prev_hover)
-                tag = self.tree.item(self._prev_hover, "tags")[0]
-                self.tree.item(self._prev_hover, tags=(tag,))
-            if row_id:
-                self.tree.item(row_id, tags=("hover",))
-            self._prev_hover = row_id
+        # <Motion> fires per pixel; only touch the tree when the hovered row changes
+        row_id = self.tree.identify_row(event.y) or None
+        if row_id == self._prev_hover:
+            return
+        prev, self._prev_hover = self._prev_hover, row_id
+        if prev is not None:
+            self._restore_tags(prev)
+        if row_id is not None:
+            self.tree.item(row_id, tags=("hover",))
 
     def _clear_hover(self):
-        if self._prev_hover and self.tree.exists(self._prev_hover):
-            tag = self.tree.item(self._prev_hover, "tags")[0]
-            self.tree.item(self._prev_hover, tags=(tag,))
-        self._prev_hover = None
+        prev, self._prev_hover = self._prev_hover, None
+        if prev is not None:
+            self._restore_tags(prev)
 
     def _on_select(self, event):
-        for row in self.tree.get_children():
-            tags = self.tree.item(row, "tags")
-            if "selected" in tags:
-                self.tree.item(row, tags=(tags[0],))
-        sel = self.tree.selection()
-        for s in sel:
-            current_tags = self.tree.item(s, "tags")
-            self.tree.item(s, tags=current_tags + ("selected",))
+        # retag only rows whose selection state changed
+        sel = set(self.tree.selection())
+        changed = sel ^ self._prev_selection
+        self._prev_selection = sel
+        for iid in changed:
+            self._restore_tags(iid)
 
     def refresh_list(self):
         q = self.var_search.get().strip()
         filter_val = self.var_filter.get()
 
-        base_query = "SELECT id, name, qty, buy_price, sell_price, sold_qty FROM products"
-        rows = []
-        if filter_val in ("پرفروش‌ترین", "پربازده‌ترین"):
-            # we'll handle these specially
-            if filter_val == "پرفروش‌ترین":
-                # order by sold_qty desc
-                if q == "":
-                    rows = self.db_query(base_query + " ORDER BY sold_qty DESC")
-                else:
-                    rows = self.db_query(base_query + " WHERE name LIKE ? ORDER BY sold_qty DESC", (f"%{q}%",))
-            else:
-                # پربازده‌ترین -> order by (sold_qty*(sell-buy)) desc
-                if q == "":
-                    rows = self.db_query(base_query + " ORDER BY (sold_qty * (sell_price - buy_price)) DESC")
-                else:
-                    rows = self.db_query(base_query + " WHERE name LIKE ? ORDER BY (sold_qty * (sell_price - buy_price)) DESC", (f"%{q}%",))
-        else:
-            if q == "":
-                rows = self.db_query(base_query + " ORDER BY id DESC")
-            else:
-                rows = self.db_query(base_query + " WHERE name LIKE ? ORDER BY id DESC", (f"%{q}%",))
-
-        for r in self.tree.get_children():
-            self.tree.delete(r)
-
-        # if filter "کمترین موجودی", sort by qty asc
-        if filter_val == "کمترین موجودی":
-            rows = sorted(rows, key=lambda x: x[2])
-
-        for idx, product in enumerate(rows):
-            pid, name, qty, buy, sell, sold = product
-
-            if qty <= 0:
-                # keep DB clean: delete items with zero or negative quantity
-                try:
-                    self.db_execute("DELETE FROM products WHERE id=?", (pid,))
-                except:
-                    pass
-                continue
-
-            if filter_val == "کمتر از 5" and qty >= 5:
-                continue
-
-            percent_sold = int(sold / (sold + qty) * 100) if (sold + qty) > 0 else 0
-            tag = "odd" if idx % 2 == 0 else "even"
-
-            if qty <= self.low_stock_threshold:
+        # filtering and ordering happen in SQLite; only displayable rows come back.
+        # sold-out products stay in the table (hidden here) so undo and sales history still resolve them
+        where = ["qty > 0"]
+        params = []
+        if filter_val == "کمتر از 5":
+            where.append("qty < 5")
+        if q:
+            where.append("id IN (SELECT rowid FROM products_fts WHERE products_fts MATCH ?)")
+            params.append(fts_phrase(q))
+        order_by = FILTER_ORDER_BY.get(filter_val, "id DESC")
+        # percent sold is computed by SQLite alongside the row
+        self.db_query("SELECT id, name, qty, buy_price, sell_price, sold_qty,"
+                      " CASE WHEN (sold_qty + qty) > 0 THEN (sold_qty * 100) / (sold_qty + qty) ELSE 0 END"
+                      f" FROM products WHERE {' AND '.join(where)} ORDER BY {order_by}", params,
+                      callback=self._show_rows, read=True)
+
+    def _show_rows(self, rows):
+        low = self.low_stock_threshold
+        new_rows = []
+        for idx, (pid, name, qty, buy, sell, sold, pct) in enumerate(rows):
+            if qty <= low:
                 tag = "low"
+            else:
+                tag = "odd" if idx % 2 == 0 else "even"
+            new_rows.append((str(pid), (pid, name, qty, _fmt_price(buy), _fmt_price(sell), sold, f"{pct}%"), tag))
 
-            self.tree.insert("", tk.END, values=(pid, name, qty, format_price_display(buy), format_price_display(sell), sold, f"{percent_sold}%"), tags=(tag,))
-            self._highlight_rows[pid] = 0
-
+        self._sort_keys = {str(row[0]): row for row in rows}
+        self._sync_tree(new_rows)
         self.update_report()
 
+    def _sync_tree(self, new_rows):
+        """Bring the tree in line with new_rows [(iid, values, tag), ...] touching only changed rows"""
+        new_map = {iid: (values, tag) for iid, values, tag in new_rows}
+        for iid in self._displayed.keys() - new_map.keys():
+            self.tree.delete(iid)
+        for index, (iid, values, tag) in enumerate(new_rows):
+            shown = self._displayed.get(iid)
+            if shown is None:
+                self.tree.insert("", index, iid=iid, values=values, tags=self._tags_for(iid, tag))
+            elif shown != (values, tag):
+                self.tree.item(iid, values=values, tags=self._tags_for(iid, tag))
+        order = [iid for iid, _, _ in new_rows]
+        if list(self.tree.get_children("")) != order:
+            self.tree.set_children("", *order)
+        self._displayed = new_map
+
     def add_product(self):
         name = self.var_name.get().strip()
         qty = self.var_qty.get().strip()
-        buy = clean_price_text(self.var_buy.get())
-        sell = clean_price_text(self.var_sell.get())
 
-        if not (name and qty and buy and sell):
+        if not (name and qty and self.ent_buy.get().strip() and self.ent_sell.get().strip()):
             messagebox.showwarning("اطلاعات ناقص", "لطفاً تمام فیلدها را پر کنید.")
             return
 
         try:
             qi = int(qty)
-            bi = int(buy)
-            si = int(sell)
-        except:
+            bi = parse_price(self.var_buy.get())
+            si = parse_price(self.var_sell.get())
+        except ValueError:
             messagebox.showerror("خطا", "مقادیر عددی معتبر نیستند.")
             return
 
-        # insert and get lastrowid to push undo properly
-        try:
-            conn = get_connection(self.db_path)
-            c = conn.cursor()
-            c.execute("INSERT INTO products (name, qty, buy_price, sell_price) VALUES (?, ?, ?, ?)", (name, qi, bi, si))
+        # insert and log share one transaction
+        def work(c):
+            c.execute(SQL_INSERT_PRODUCT, (name, qi, bi, si))
             last_id = c.lastrowid
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            logging.exception("Insert product failed: %s", e)
+            self._log("ADD", f"{name} | qty={qi} buy={bi} sell={si}", cursor=c)
+            return last_id
+
+        def done(last_id):
+            self._wrote()
+            self._push_undo("ADD", {"product_id": last_id})
+            self.clear_entries()
+            self.schedule_refresh()
+            self.status_label.config(text=f"کالا '{name}' اضافه شد.")
+
+        def failed(e):
+            logging.error("Insert product failed: %s", e, exc_info=e)
             messagebox.showerror("خطا", "افزودن کالا با خطا مواجه شد.")
-            return
 
-        log_action(self.db_path, "ADD", f"{name} | qty={qi} buy={bi} sell={si}")
-        # push undo info (persistent)
-        self._push_undo("ADD", {"product_id": last_id})
-
-        self.clear_entries()
-        self.refresh_list()
-        self.status_label.config(text=f"کالا '{name}' اضافه شد.")
+        self.db_transaction(work, done, failed)
 
     def clear_entries(self):
         self.var_name.set("")
         self.var_qty.set("")
         self.var_buy.set("")
         self.var_sell.set("")
+        self.lbl_buy.config(text="")
+        self.lbl_sell.config(text="")
 
     def sell_item(self, qty_to_sell=1):
         sel = self.tree.selection()
@@ -577,67 +931,93 @@ class CafenetApp(ttk.Frame):
             # ensure integer
             if isinstance(qty_to_sell, str):
                 qty_to_sell = int(qty_to_sell)
-            elif isinstance(qty_to_sell, tk.StringVar):
-                qty_to_sell = int(qty_to_sell.get())
-            elif isinstance(qty_to_sell, tk.IntVar):
+            elif isinstance(qty_to_sell, (tk.StringVar, tk.IntVar)):
                 qty_to_sell = int(qty_to_sell.get())
-        except:
+        except (ValueError, tk.TclError):
+            # IntVar.get raises TclError on non-numeric text
             qty_to_sell = 1
 
         if qty_to_sell < 1:
             qty_to_sell = 1
 
-        values = self.tree.item(sel[0])["values"]
-        pid = values[0]
+        # every selected row goes into one cart and one transaction
+        pids = [self.tree.item(s)["values"][0] for s in sel]
+        rows = self.db_query(SQL_SELECT_PRODUCTS, (json.dumps(pids),))
+        stock = {pid: (name, qty) for pid, name, qty, *_ in rows}
 
-        rows = self.db_query("SELECT name, qty, sold_qty, buy_price, sell_price FROM products WHERE id=?", (pid,))
-        if not rows:
-            return
-
-        name, qty, sold, buy_price, sell_price = rows[0]
-
-        if qty <= 0:
-            messagebox.showinfo("ناموجود", f"کالای '{name}' در انبار موجود نیست.")
-            return
-
-        if qty_to_sell > qty:
-            if not messagebox.askyesno("عدم موجودی کافی", f"موجودی فعلی {qty} است. آیا مایلید {qty} عدد فروخته شود؟"):
+        cart = []
+        for pid in pids:
+            if pid not in stock:
+                continue
+            name, qty = stock[pid]
+            if qty <= 0:
+                messagebox.showinfo("ناموجود", f"کالای '{name}' در انبار موجود نیست.")
+                continue
+            qty_item = qty_to_sell
+            if qty_item > qty:
+                if not messagebox.askyesno("عدم موجودی کافی", f"موجودی فعلی {qty} است. آیا مایلید {qty} عدد فروخته شود؟"):
+                    continue
+                qty_item = qty
+            cart.append((pid, qty_item))
+
+        if cart:
+            self.sell_items(cart)
+
+    def sell_items(self, items):
+        """Sell [(product_id, qty), ...] in one transaction; quantities are expected to be checked against stock"""
+        cart = {}
+        for pid, qty in items:
+            cart[pid] = cart.get(pid, 0) + qty
+
+        # product updates, sales_log rows and log entries share one transaction
+        def work(c):
+            c.execute(SQL_SELECT_PRODUCTS, (json.dumps(list(cart)),))
+            products = {r[0]: r[1:] for r in c.fetchall()}
+            lines = [(pid, qty) for pid, qty in cart.items() if pid in products]
+            if not lines:
+                return [], [], None
+            c.executemany(SQL_SELL_PRODUCT,
+                          [(qty, qty, pid) for pid, qty in lines])
+            ts = datetime.now().isoformat()
+            c.executemany(SQL_INSERT_SALE,
+                          [(pid, qty, products[pid][3], products[pid][4], (products[pid][4] - products[pid][3]) * qty, ts)
+                           for pid, qty in lines])
+            # rows were inserted back to back in this transaction, so their ids are consecutive
+            first_sale_id = c.execute("SELECT last_insert_rowid()").fetchone()[0] - len(lines) + 1
+            undo_items = []
+            names = []
+            for i, (pid, qty) in enumerate(lines):
+                name, prev_qty, prev_sold, _, _ = products[pid]
+                undo_items.append({
+                    "product_id": pid,
+                    "qty": qty,
+                    "prev_qty": prev_qty,
+                    "prev_sold": prev_sold,
+                    "sales_log_id": first_sale_id + i
+                })
+                names.append(name)
+                self._log("SELL", f"{name} id={pid} qty_sold={qty} qty_before={prev_qty} qty_after={prev_qty - qty}", cursor=c)
+            # the triggers have already added this sale's profit to stats; read the totals back with the write
+            return undo_items, names, c.execute(SQL_REPORT_TOTALS).fetchone()
+
+        def done(result):
+            undo_items, names, totals = result
+            if not undo_items:
                 return
-            qty_to_sell = qty
-
-        newq = qty - qty_to_sell
-        newsold = sold + qty_to_sell
+            self._wrote(totals)
+            # push undo info including sales_log ids for reliable undo
+            self._push_undo("SELL_BATCH", {"items": undo_items})
+            self.schedule_refresh()
+            if len(undo_items) == 1:
+                self.status_label.config(text=f"{undo_items[0]['qty']} عدد از محصول '{names[0]}' فروخته شد.")
+            else:
+                self.status_label.config(text=f"{len(undo_items)} کالا فروخته شد.")
 
-        # update product quantities
-        try:
-            conn = get_connection(self.db_path)
-            c = conn.cursor()
-            c.execute("UPDATE products SET qty=?, sold_qty=? WHERE id=?", (newq, newsold, pid))
-            # compute profit and insert sales_log, get its id for undo
-            profit = (sell_price - buy_price) * qty_to_sell
-            c.execute("INSERT INTO sales_log (product_id, qty, price_buy, price_sell, profit, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-                      (pid, qty_to_sell, buy_price, sell_price, profit, datetime.now().isoformat()))
-            sales_log_id = c.lastrowid
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            logging.exception("Failed to perform sell operation: %s", e)
+        def failed(e):
+            logging.error("Failed to perform sell operation: %s", e, exc_info=e)
             messagebox.showerror("خطا", "عملیات فروش با خطا مواجه شد.")
-            return
-
-        # push undo info including sales_log_id for reliable undo
-        self._push_undo("SELL", {
-            "product_id": pid,
-            "qty": qty_to_sell,
-            "prev_qty": qty,
-            "prev_sold": sold,
-            "sales_log_id": sales_log_id
-        })
 
-        log_action(self.db_path, "SELL", f"{name} id={pid} qty_sold={qty_to_sell} qty_before={qty} qty_after={newq}")
-
-        self.refresh_list()
-        self.status_label.config(text=f"{qty_to_sell} عدد از محصول '{name}' فروخته شد.")
+        self.db_transaction(work, done, failed)
 
     def delete_item(self):
         sel = self.tree.selection()
@@ -645,161 +1025,280 @@ class CafenetApp(ttk.Frame):
             messagebox.showwarning("هیچ کالا انتخاب نشده", "لطفاً یک کالا از لیست انتخاب کنید.")
             return
 
-        pid = self.tree.item(sel[0])["values"][0]
-        rows = self.db_query("SELECT name, qty, buy_price, sell_price, sold_qty FROM products WHERE id=?", (pid,))
+        # every selected row is removed (and later restored) in one transaction
+        pids = [self.tree.item(s)["values"][0] for s in sel]
+        rows = self.db_query(SQL_SELECT_PRODUCTS, (json.dumps(pids),))
         if not rows:
             return
-        name, qty, buy, sell, sold = rows[0]
+        items = [{"product_id": pid, "data": {"name": name, "qty": qty, "buy": buy, "sell": sell, "sold": sold}}
+                 for pid, name, qty, sold, buy, sell in rows]
 
-        if not messagebox.askyesno("تأیید حذف", f"آیا از حذف محصول '{name}' اطمینان دارید؟"):
+        if len(items) == 1:
+            prompt = f"آیا از حذف محصول '{items[0]['data']['name']}' اطمینان دارید؟"
+        else:
+            prompt = f"آیا از حذف {len(items)} محصول اطمینان دارید؟"
+        if not messagebox.askyesno("تأیید حذف", prompt):
             return
 
-        # store to undo stack (persistent) with full data
-        self._push_undo("DELETE", {
-            "product_id": pid,
-            "data": {"name": name, "qty": qty, "buy": buy, "sell": sell, "sold": sold}
-        })
+        def work(c):
+            c.executemany(SQL_DELETE_PRODUCT, [(it["product_id"],) for it in items])
+            for it in items:
+                self._log("DELETE", f"id={it['product_id']} name={it['data']['name']}", cursor=c)
+
+        def done(_):
+            self._wrote()
+            # store to undo stack with full data
+            self._push_undo("DELETE_BATCH", {"items": items})
+            self.schedule_refresh()
+            if len(items) == 1:
+                self.status_label.config(text=f"محصول '{items[0]['data']['name']}' حذف شد.")
+            else:
+                self.status_label.config(text=f"{len(items)} محصول حذف شد.")
 
-        self.db_execute("DELETE FROM products WHERE id=?", (pid,))
-        log_action(self.db_path, "DELETE", f"id={pid} name={name}")
-        self.refresh_list()
-        self.status_label.config(text=f"محصول '{name}' حذف شد.")
+        def failed(e):
+            logging.error("Delete product failed: %s", e, exc_info=e)
+            messagebox.showerror("خطا", "حذف کالا با خطا مواجه شد.")
+
+        self.db_transaction(work, done, failed)
 
     def undo_last(self):
-        entry = self._pop_undo_db()
+        entry = self._pop_undo()
         if not entry:
             messagebox.showinfo("Undo", "هیچ عملی برای بازگردانی وجود ندارد.")
             return
         act = entry.get("action")
         payload = entry.get("payload", {})
-        try:
+        # revert and log share one transaction; returns the status text
+        def work(c):
             if act == "ADD":
                 pid = payload.get("product_id")
                 # delete product that was added
-                self.db_execute("DELETE FROM products WHERE id=?", (pid,))
-                log_action(self.db_path, "UNDO_ADD", f"deleted id={pid}")
-                self.status_label.config(text="عمل افزودن بازگردانده شد.")
-            elif act == "SELL":
-                pid = payload.get("product_id")
-                qty = payload.get("qty", 1)
-                prev_qty = payload.get("prev_qty")
-                prev_sold = payload.get("prev_sold")
-                sales_log_id = payload.get("sales_log_id")
-                # revert product quantities
-                if prev_qty is not None and prev_sold is not None:
-                    self.db_execute("UPDATE products SET qty=?, sold_qty=? WHERE id=?", (prev_qty, prev_sold, pid))
-                else:
-                    # best effort: add back qty
-                    self.db_execute("UPDATE products SET qty=qty + ?, sold_qty = MAX(sold_qty - ?, 0) WHERE id=?", (qty, qty, pid))
-                # remove the sales_log entry if exists (use saved id)
-                if sales_log_id:
-                    try:
-                        self.db_execute("DELETE FROM sales_log WHERE id=?", (sales_log_id,))
-                    except:
-                        # fallback: remove one matching recent entry
-                        try:
-                            conn = get_connection(self.db_path)
-                            c = conn.cursor()
-                            c.execute("SELECT id FROM sales_log WHERE product_id=? AND qty=? ORDER BY timestamp DESC LIMIT 1", (pid, qty))
-                            row = c.fetchone()
-                            if row:
-                                c.execute("DELETE FROM sales_log WHERE id=?", (row[0],))
-                                conn.commit()
-                            conn.close()
-                        except:
-                            pass
-                log_action(self.db_path, "UNDO_SELL", f"reverted id={pid} qty={qty}")
-                self.status_label.config(text="عمل فروش بازگردانده شد.")
-            elif act == "DELETE":
-                data = payload.get("data", {})
-                pid = payload.get("product_id")
-                # try to re-insert with same id
-                try:
-                    conn = get_connection(self.db_path)
-                    c = conn.cursor()
-                    c.execute("INSERT INTO products (id, name, qty, buy_price, sell_price, sold_qty) VALUES (?, ?, ?, ?, ?, ?)",
-                              (pid, data.get("name"), data.get("qty", 0), data.get("buy", 0), data.get("sell", 0), data.get("sold", 0)))
-                    conn.commit()
-                    conn.close()
-                except Exception:
-                    # fallback: insert without id
-                    try:
-                        self.db_execute("INSERT INTO products (name, qty, buy_price, sell_price, sold_qty) VALUES (?, ?, ?, ?, ?)",
-                                        (data.get("name"), data.get("qty", 0), data.get("buy", 0), data.get("sell", 0), data.get("sold", 0)))
-                    except Exception:
-                        logging.exception("Failed restore deleted product.")
-                log_action(self.db_path, "UNDO_DELETE", f"restored id={pid} name={data.get('name')}")
-                self.status_label.config(text="عمل حذف بازگردانده شد.")
+                c.execute(SQL_DELETE_PRODUCT, (pid,))
+                self._log("UNDO_ADD", f"deleted id={pid}", cursor=c)
+                return "عمل افزودن بازگردانده شد."
+            elif act == "SELL_BATCH":
+                items = payload.get("items", [])
+                # relative, so sales made after this one are kept
+                c.executemany(SQL_UNSELL_PRODUCT, [(it["qty"], it["qty"], it["product_id"]) for it in items])
+                c.executemany(SQL_DELETE_SALE, [(it["sales_log_id"],) for it in items])
+                for it in items:
+                    self._log("UNDO_SELL", f"reverted id={it['product_id']} qty={it['qty']}", cursor=c)
+                return "عمل فروش بازگردانده شد."
+            elif act == "DELETE_BATCH":
+                items = payload.get("items", [])
+                # re-insert under the original ids and keep AUTOINCREMENT's high-water mark past them
+                c.executemany(SQL_RESTORE_PRODUCT,
+                              [(it["product_id"], it["data"].get("name"), it["data"].get("qty", 0), it["data"].get("buy", 0),
+                                it["data"].get("sell", 0), it["data"].get("sold", 0)) for it in items])
+                c.execute(SQL_BUMP_PRODUCT_SEQ, (max(it["product_id"] for it in items),))
+                for it in items:
+                    self._log("UNDO_DELETE", f"restored id={it['product_id']} name={it['data'].get('name')}", cursor=c)
+                return "عمل حذف بازگردانده شد."
+
+        def done(status):
+            self._wrote()
+            if status:
+                self.status_label.config(text=status)
             else:
                 messagebox.showwarning("Undo", "نوع عملیات قابل بازگردانی نیست.")
-        except Exception as e:
-            logging.exception("Undo failed: %s", e)
+            self.schedule_refresh()
+
+        def failed(e):
+            # keep the entry so the undo can be retried
+            self._undo_stack.append(entry)
+            logging.error("Undo failed: %s", e, exc_info=e)
             messagebox.showerror("خطا", "عمل بازگردانی با خطا مواجه شد.")
-        self.refresh_list()
+            self.schedule_refresh()
+
+        self.db_transaction(work, done, failed)
+
+    def _wrote(self, totals=None):
+        """called from each write's done callback; totals, when given, were read inside that write"""
+        self._write_gen += 1
+        self._report_cache = totals
 
     def update_report(self):
-        totals = self.db_query("SELECT COUNT(*), COALESCE(SUM(qty),0), COALESCE(SUM(qty*buy_price),0), COALESCE(SUM(sold_qty),0) FROM products")
-        cnt, total_qty, total_value, total_sold = totals[0] if totals else (0, 0, 0, 0)
-        # total profit from sales_log
-        profit_rows = self.db_query("SELECT COALESCE(SUM(profit),0) FROM sales_log")
-        total_profit = profit_rows[0][0] if profit_rows else 0
+        if self._report_cache is not None:
+            self._show_report(self._report_cache)
+            return
+        gen = self._write_gen
+        self._db_submit(lambda conn: conn.execute(SQL_REPORT_TOTALS).fetchone(),
+                        callback=lambda totals: self._report_read(gen, totals), read=True)
+
+    def _report_read(self, gen, totals):
+        # the read worker doesn't queue behind writes, so its snapshot may predate a write that has
+        # since finished; that write's own refresh brings the current totals
+        if gen != self._write_gen:
+            return
+        self._report_cache = totals
+        self._show_report(totals)
 
+    def _show_report(self, totals):
+        cnt, total_qty, total_value, total_sold, total_profit = totals
         txt = f"کالا: {cnt}   موجودی کل: {total_qty}   ارزش موجودی: {total_value:,}   فروخته‌شده: {total_sold}   سود کل: {total_profit:,} تومان"
         self.report_label.config(text=txt)
 
     def sort_by_column(self, col, reverse):
-        data = [(self.tree.set(k, col), k) for k in self.tree.get_children("")]
-        try:
-            data.sort(key=lambda t: int(t[0].replace("%","").replace(",","")), reverse=reverse)
-        except:
-            data.sort(reverse=reverse)
-
-        for index, (val, k) in enumerate(data):
-            self.tree.move(k, "", index)
+        # sort on the raw values behind each row; "1,234 تومان" and "40%" columns compare as numbers
+        idx = self.tree["columns"].index(col)
+        keys = self._sort_keys
+        data = sorted(self.tree.get_children(""), key=lambda k: keys[k][idx], reverse=reverse)
+        # one Tcl call reorders every row, instead of a move (and relayout) per row
+        self.tree.set_children("", *data)
 
         self.tree.heading(col, command=lambda: self.sort_by_column(col, not reverse))
 
     def open_sales_history(self):
+        # the window is built once and only hidden on close; reopening reloads its first page
+        if self._sales_win is not None and self._sales_win.winfo_exists():
+            self._sales_reload()
+            self._sales_win.deiconify()
+            self._sales_win.lift()
+            return
+
         # open a Toplevel window showing rows from sales_log
         win = tk.Toplevel(self.root)
         win.title("تاریخچه فروش")
         win.geometry("900x500")
         cols = ("id", "نام کالا", "تعداد", "قیمت خرید", "قیمت فروش", "سود", "زمان")
-        tree = ttk.Treeview(win, columns=cols, show="headings")
+        search_frame = ttk.Frame(win)
+        search_frame.pack(fill="x", padx=6, pady=(6,0))
+        ttk.Label(search_frame, text="جستجو:").pack(side="left")
+        var_search = tk.StringVar()
+        ent_search = tk.Entry(search_frame, textvariable=var_search, bg="#FFFFFF", fg="#000000", insertbackground="#000000")
+        ent_search.pack(side="left", padx=8, fill="x", expand=True)
+        body = ttk.Frame(win)
+        body.pack(fill="both", expand=True, padx=6, pady=6)
+        tree = ttk.Treeview(body, columns=cols, show="headings")
         for c in cols:
             tree.heading(c, text=c)
             tree.column(c, anchor="center", stretch=True)
-        tree.pack(fill="both", expand=True, padx=6, pady=6)
-
-        # fetch sales with product names
-        rows = self.db_query("""
-            SELECT s.id, p.name, s.qty, s.price_buy, s.price_sell, s.profit, s.timestamp
-            FROM sales_log s
-            LEFT JOIN products p ON p.id = s.product_id
-            ORDER BY s.timestamp DESC
-            LIMIT 2000
-        """)
-        for r in rows:
-            sid, pname, qty, pb, ps, profit, ts = r
-            tree.insert("", tk.END, values=(sid, pname or "(نامشخص)", qty, format_price_display(pb), format_price_display(ps), format_price_display(profit), ts))
+        scrollbar = ttk.Scrollbar(body, orient="vertical", command=tree.yview)
+        scrollbar.pack(side="right", fill="y")
+        tree.pack(side="left", fill="both", expand=True)
 
         btn_frame = ttk.Frame(win)
         btn_frame.pack(fill="x", padx=6, pady=6)
         ttk.Button(btn_frame, text="حذف رکورد انتخاب‌شده", command=lambda: self._delete_sales_record(tree)).pack(side="left", padx=6)
-        ttk.Button(btn_frame, text="بستن", command=win.destroy).pack(side="right", padx=6)
+        btn_more = ttk.Button(btn_frame, text="بارگذاری بیشتر")
+        btn_more.pack(side="left", padx=6)
+
+        # sales are fetched one page at a time, keyed on the smallest id shown so far;
+        # scrolling near the bottom pulls the next page, the button does the same by hand.
+        # a new search bumps "gen" so pages still in flight for the old one are dropped
+        cursor = {"last_id": sys.maxsize, "loading": False, "exhausted": False, "query": "", "gen": 0, "after": None}
+        # product id -> name for this window; only touched by jobs on the read worker
+        names = {}
+
+        def show_page(gen, rows):
+            if not win.winfo_exists() or gen != cursor["gen"]:
+                return
+            cursor["loading"] = False
+            if tree.exists(HISTORY_LOADING_IID):
+                tree.delete(HISTORY_LOADING_IID)
+            # build every display tuple first so the insert loop is nothing but Tcl calls
+            values = [(sid, pname or "(نامشخص)", qty, _fmt_price(pb), _fmt_price(ps), _fmt_price(profit), ts)
+                      for sid, pname, qty, pb, ps, profit, ts in rows]
+            insert = tree.insert
+            for v in values:
+                insert("", tk.END, values=v)
+            if rows:
+                cursor["last_id"] = rows[-1][0]
+            if len(rows) < HISTORY_PAGE_SIZE:
+                cursor["exhausted"] = True
+                btn_more.state(["disabled"])
+            else:
+                btn_more.state(["!disabled"])
+
+        def load_more():
+            if cursor["loading"] or cursor["exhausted"]:
+                return
+            cursor["loading"] = True
+            btn_more.state(["disabled"])
+            gen, last_id, query = cursor["gen"], cursor["last_id"], cursor["query"]
+
+            def job(conn):
+                if query:
+                    pids = [r[0] for r in conn.execute(SQL_MATCHING_PRODUCTS, (fts_phrase(query),))]
+                    if len(pids) <= HISTORY_SEEK_MAX_PRODUCTS:
+                        # a few (often rare) products: one seek each returns at most a page, already newest
+                        # first, so a page reads at most HISTORY_SEEK_MAX_PRODUCTS pages of rows
+                        pages = [conn.execute(SQL_PRODUCT_SALES_PAGE, (pid, last_id, HISTORY_PAGE_SIZE)).fetchall()
+                                 for pid in pids]
+                        rows = list(itertools.islice(heapq.merge(*pages, key=lambda r: r[0], reverse=True), HISTORY_PAGE_SIZE))
+                    else:
+                        # broad match: sales of these products are common, so the reverse rowid scan fills a page fast
+                        rows = conn.execute(SQL_PRODUCTS_SALES_PAGE, (json.dumps(pids), last_id, HISTORY_PAGE_SIZE)).fetchall()
+                else:
+                    rows = conn.execute(SQL_SALES_PAGE, (last_id, HISTORY_PAGE_SIZE)).fetchall()
+                # a page usually repeats a few products, so only names not seen yet in this window are fetched
+                missing = {r[1] for r in rows if r[1] is not None and r[1] not in names}
+                if missing:
+                    names.update(conn.execute(SQL_PRODUCT_NAMES, (json.dumps(list(missing)),)).fetchall())
+                return [(sid, names.get(pid), *rest) for sid, pid, *rest in rows]
+
+            self._db_submit(job, callback=lambda rows: show_page(gen, rows), read=True)
+
+        def reload(query):
+            cursor.update(last_id=sys.maxsize, loading=False, exhausted=False, query=query, gen=cursor["gen"] + 1)
+            tree.delete(*tree.get_children(""))
+            # the window is usable at once; this row stands in until the worker returns the first page
+            tree.insert("", tk.END, iid=HISTORY_LOADING_IID, values=("", "در حال بارگذاری...", "", "", "", "", ""))
+            load_more()
+
+        def run_search():
+            cursor["after"] = None
+            query = var_search.get().strip()
+            if query != cursor["query"]:
+                reload(query)
+
+        def on_search_key(event):
+            if cursor["after"]:
+                win.after_cancel(cursor["after"])
+            cursor["after"] = win.after(SEARCH_DEBOUNCE_MS, run_search)
+
+        def on_scroll(first, last):
+            scrollbar.set(first, last)
+            if float(last) >= HISTORY_PREFETCH_AT:
+                load_more()
+
+        tree.configure(yscrollcommand=on_scroll)
+        ent_search.bind("<KeyRelease>", on_search_key)
+        btn_more.configure(command=load_more)
+        ttk.Button(btn_frame, text="بستن", command=win.withdraw).pack(side="right", padx=6)
+        win.protocol("WM_DELETE_WINDOW", win.withdraw)
+        self._sales_win = win
+        self._sales_reload = lambda: reload(cursor["query"])
+        reload("")
 
     def _delete_sales_record(self, treeview):
-        sel = treeview.selection()
+        sel = [s for s in treeview.selection() if s != HISTORY_LOADING_IID]
         if not sel:
             return
-        sid = treeview.item(sel[0])["values"][0]
-        if messagebox.askyesno("حذف", "آیا از حذف رکورد فروش اطمینان دارید؟"):
-            self.db_execute("DELETE FROM sales_log WHERE id=?", (sid,))
-            log_action(self.db_path, "DELETE_SALE", f"id={sid}")
-            treeview.delete(sel[0])
-            self.update_report()
+        sids = [treeview.item(s)["values"][0] for s in sel]
+        if not messagebox.askyesno("حذف", "آیا از حذف رکورد فروش اطمینان دارید؟"):
+            return
+
+        # every selected record goes in one transaction with a single log entry
+        def work(c):
+            c.executemany(SQL_DELETE_SALE, [(sid,) for sid in sids])
+            self._log("DELETE_SALE", "id=" + ",".join(map(str, sids)), cursor=c)
+            return c.execute(SQL_REPORT_TOTALS).fetchone()
+
+        def done(totals):
+            if treeview.winfo_exists():
+                # a search or reopen may have reloaded the tree while the delete was queued
+                treeview.delete(*[s for s in sel if treeview.exists(s)])
+            self._wrote(totals)
+            self._show_report(totals)
             messagebox.showinfo("حذف", "رکورد حذف شد.")
 
+        def failed(e):
+            logging.error("Delete sales record failed: %s", e, exc_info=e)
+            messagebox.showerror("خطا", "حذف رکورد فروش با خطا مواجه شد.")
+
+        self.db_transaction(work, done, failed)
+
 def main():
     if USE_TTKBOOTSTRAP:
         root = tb.Window(themename="darkly")
@@ -810,14 +1309,14 @@ def main():
     db_folder = get_database_folder()
     db_path = os.path.join(db_folder, DB_FILENAME)
 
-    init_db(db_path)
-
     root.deiconify()
     app = CafenetApp(root, db_path)
     app.pack(fill="both", expand=True)
 
     def on_close():
         stop_backups()
+        app.save_undo_stack()
+        app.close_db()
         root.destroy()
 
     root.protocol("WM_DELETE_WINDOW", on_close)